@@ -1,8 +1,18 @@
 import os
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
+from xarray_esgf.client import MAX_WORKERS
+
 
 @pytest.fixture
 def index_node() -> str:
     return os.getenv("ESGPULL_INDEX_NODE", "esgf.ceda.ac.uk")
+
+
+@pytest.fixture(scope="session")
+def executor() -> Iterator[ThreadPoolExecutor]:
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        yield executor
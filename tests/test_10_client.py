@@ -1,12 +1,27 @@
+import contextlib
+import shutil
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Any
 
 import pytest
+import xarray as xr
+from esgpull import File
 
 from xarray_esgf import Client
+from xarray_esgf.client import bounded_map, combine_datasets
 
 
+@pytest.mark.parametrize("parallel_parts", [1, 4])
 @pytest.mark.parametrize("check_files", [True, False])
-def test_download(tmp_path: Path, index_node: str, check_files: bool) -> None:
+def test_download(
+    tmp_path: Path,
+    index_node: str,
+    executor: ThreadPoolExecutor,
+    check_files: bool,
+    parallel_parts: int,
+) -> None:
     selection: dict[str, str | list[str]] = {
         "query": '"tas_Amon_EC-Earth3-CC_ssp245_r1i1p1f1_gr_201901-201912.nc"'
     }
@@ -14,7 +29,9 @@ def test_download(tmp_path: Path, index_node: str, check_files: bool) -> None:
         selection,
         esgpull_path=str(tmp_path / "esgpull"),
         index_node=index_node,
+        executor=executor,
         check_files=check_files,
+        parallel_parts=parallel_parts,
     )
 
     downloaded = client.download()
@@ -22,3 +39,133 @@ def test_download(tmp_path: Path, index_node: str, check_files: bool) -> None:
 
     downloaded = client.download()
     assert len(downloaded) == 0
+
+
+@pytest.mark.parametrize("refresh", [True, False])
+def test_files_cache(
+    tmp_path: Path,
+    index_node: str,
+    executor: ThreadPoolExecutor,
+    refresh: bool,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    selection: dict[str, str | list[str]] = {
+        "query": '"tas_Amon_EC-Earth3-CC_ssp245_r1i1p1f1_gr_201901-201912.nc"'
+    }
+    esgpull_path = str(tmp_path / "esgpull")
+    client = Client(
+        selection,
+        esgpull_path=esgpull_path,
+        index_node=index_node,
+        executor=executor,
+    )
+    expected = [file.asdict() for file in client.files]
+    assert len(expected) == 1
+
+    client = Client(
+        selection,
+        esgpull_path=esgpull_path,
+        index_node=index_node,
+        executor=executor,
+        refresh=refresh,
+    )
+
+    def files(*args: Any, **kwargs: Any) -> list[File]:
+        raise ConnectionError
+
+    monkeypatch.setattr(client._client.context, "files", files)
+    with pytest.raises(ConnectionError) if refresh else contextlib.nullcontext():
+        assert [file.asdict() for file in client.files] == expected
+
+
+def test_esgpull_cache(tmp_path: Path) -> None:
+    esgpull_path = tmp_path / "esgpull"
+    client = Client({"query": "foo"}, esgpull_path=str(esgpull_path))._client
+    assert Client({"query": "bar"}, esgpull_path=str(esgpull_path))._client is client
+
+    shutil.rmtree(esgpull_path)
+    new_client = Client({"query": "foo"}, esgpull_path=str(esgpull_path))._client
+    assert new_client is not client
+    assert esgpull_path.is_dir()
+
+
+def test_files_cache_empty(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    client = Client({"query": "foo"}, esgpull_path=str(tmp_path / "esgpull"))
+
+    def files(*args: Any, **kwargs: Any) -> list[File]:
+        return []
+
+    monkeypatch.setattr(client._client.context, "files", files)
+    assert client.files == []
+    assert not client._files_cache_path.exists()
+
+
+@pytest.mark.parametrize("download", [True, False])
+def test_peek_dims(
+    tmp_path: Path, index_node: str, executor: ThreadPoolExecutor, download: bool
+) -> None:
+    selection: dict[str, str | list[str]] = {
+        "query": '"tas_Amon_EC-Earth3-CC_ssp245_r1i1p1f1_gr_201901-201912.nc"'
+    }
+    client = Client(
+        selection,
+        esgpull_path=str(tmp_path / "esgpull"),
+        index_node=index_node,
+        executor=executor,
+    )
+    if download:
+        client.download()
+
+    (file,) = client.files
+    assert client.peek_dims(file, download=download) == {
+        "time": 12,
+        "bnds": 2,
+        "lat": 256,
+        "lon": 512,
+    }
+
+
+def test_combine_single_dataset() -> None:
+    ds = xr.Dataset({"foo": ("x", [0, 1])}, coords={"x": [0, 1]})
+    assert combine_datasets([ds]) is ds
+
+
+def test_bounded_map(executor: ThreadPoolExecutor) -> None:
+    submitted = []
+
+    def items() -> Iterator[int]:
+        for i in range(10):
+            submitted.append(i)
+            yield i
+
+    results = bounded_map(executor, lambda i: i * 2, items(), window=3)
+    assert next(results) == 0
+    assert submitted == [0, 1, 2, 3]
+    assert list(results) == [i * 2 for i in range(1, 10)]
+
+
+@pytest.mark.parametrize("mask_and_scale", [True, False])
+def test_mask_and_scale(
+    tmp_path: Path, index_node: str, executor: ThreadPoolExecutor, mask_and_scale: bool
+) -> None:
+    selection: dict[str, str | list[str]] = {
+        "query": [
+            '"tas_Amon_EC-Earth3-CC_ssp245_r1i1p1f1_gr_201901-201912.nc"',
+            '"tas_Amon_EC-Earth3-CC_ssp245_r1i1p1f1_gr_202001-202012.nc"',
+        ]
+    }
+    client = Client(
+        selection,
+        esgpull_path=str(tmp_path / "esgpull"),
+        index_node=index_node,
+        executor=executor,
+    )
+    ds = client.open_dataset(
+        concat_dims=None,
+        sel={"time": {"slice": ["2019-12", "2020-01"]}},
+        mask_and_scale=mask_and_scale,
+    )
+    assert ds.sizes["time"] == 2
+    assert ds.indexes["time"].is_monotonic_increasing
+    assert ("_FillValue" in ds["tas"].attrs) is not mask_and_scale
+    assert ("_FillValue" in ds["tas"].encoding) is mask_and_scale
@@ -1,5 +1,6 @@
 import contextlib
 from collections.abc import Hashable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any
 
@@ -10,8 +11,23 @@ from xarray import AlignmentError
 does_not_raise = contextlib.nullcontext
 
 
-@pytest.mark.parametrize("download", [True, False])
-def test_open_dataset(tmp_path: Path, index_node: str, download: bool) -> None:
+@pytest.mark.parametrize(
+    "download,hdf5_backend,trust_alignment",
+    [
+        (True, None, False),
+        (False, None, False),
+        (False, "pyfive", False),
+        (False, None, True),
+    ],
+)
+def test_open_dataset(
+    tmp_path: Path,
+    index_node: str,
+    executor: ThreadPoolExecutor,
+    download: bool,
+    hdf5_backend: str | None,
+    trust_alignment: bool,
+) -> None:
     esgpull_path = tmp_path / "esgpull"
     selection = {
         "query": [
@@ -33,7 +49,10 @@ def test_open_dataset(tmp_path: Path, index_node: str, download: bool) -> None:
         concat_dims="experiment_id",
         engine="esgf",
         index_node=index_node,
+        executor=executor,
         download=download,
+        hdf5_backend=hdf5_backend,
+        trust_alignment=trust_alignment,
         chunks={},
     )
 
@@ -75,6 +94,7 @@ def test_open_dataset(tmp_path: Path, index_node: str, download: bool) -> None:
         for name, coord in ds.coords.items()
         if name != "experiment_id"
     )
+    assert ds["experiment_id"].dtype == object
 
     # Dimensionless coords
     assert "height" not in ds["pr"].attrs
@@ -83,6 +103,11 @@ def test_open_dataset(tmp_path: Path, index_node: str, download: bool) -> None:
     # Data vars
     assert set(ds.data_vars) == {"pr", "tas"}
 
+    # Values
+    tas = ds["tas"].isel(time=[0, -1]).compute()
+    assert tas.notnull().all()
+    assert 180 < tas.min() < tas.max() < 340
+
     # Attributes
     assert (
         ds.coordinates
@@ -98,7 +123,9 @@ def test_open_dataset(tmp_path: Path, index_node: str, download: bool) -> None:
     ]
 
 
-def test_combine_coords(tmp_path: Path, index_node: str) -> None:
+def test_combine_coords(
+    tmp_path: Path, index_node: str, executor: ThreadPoolExecutor
+) -> None:
     esgpull_path = tmp_path / "esgpull"
     selection = {
         "query": [
@@ -112,6 +139,7 @@ def test_combine_coords(tmp_path: Path, index_node: str) -> None:
         concat_dims="experiment_id",
         engine="esgf",
         index_node=index_node,
+        executor=executor,
         chunks={},
     )
     assert set(ds.coords) == {"areacella", "lat", "lon", "experiment_id", "orog"}
@@ -129,6 +157,7 @@ def test_combine_coords(tmp_path: Path, index_node: str) -> None:
 def test_time_selection(
     tmp_path: Path,
     index_node: str,
+    executor: ThreadPoolExecutor,
     sel: dict[Hashable, Any],
     expected_size: int,
 ) -> None:
@@ -143,6 +172,7 @@ def test_time_selection(
         esgpull_path=esgpull_path,
         engine="esgf",
         index_node=index_node,
+        executor=executor,
         chunks={},
         sel=sel,
     )
@@ -159,6 +189,7 @@ def test_time_selection(
 def test_ignore_spatial_coords(
     tmp_path: Path,
     index_node: str,
+    executor: ThreadPoolExecutor,
     ignore_spatial_coords: str | None,
     raises: contextlib.nullcontext,
 ) -> None:
@@ -176,6 +207,7 @@ def test_ignore_spatial_coords(
             esgpull_path=esgpull_path,
             engine="esgf",
             index_node=index_node,
+            executor=executor,
             chunks={},
             ignore_spatial_coords=ignore_spatial_coords,
         )
@@ -185,6 +217,7 @@ def test_ignore_spatial_coords(
 def test_drop_attributes(
     tmp_path: Path,
     index_node: str,
+    executor: ThreadPoolExecutor,
 ) -> None:
     esgpull_path = tmp_path / "esgpull"
     selection = {
@@ -197,8 +230,35 @@ def test_drop_attributes(
         esgpull_path=esgpull_path,
         engine="esgf",
         index_node=index_node,
+        executor=executor,
         chunks={},
         drop_attributes=["contact", "standard_name"],
     )
     assert "contact" not in ds.attrs
     assert "standard_name" not in ds["tas"].attrs
+
+
+def test_to_netcdf(
+    tmp_path: Path,
+    index_node: str,
+    executor: ThreadPoolExecutor,
+) -> None:
+    esgpull_path = tmp_path / "esgpull"
+    selection = {
+        "query": [
+            '"tas_Amon_EC-Earth3-CC_ssp245_r1i1p1f1_gr_201901-201912.nc"',
+            '"CMIP6.ScenarioMIP.EC-Earth-Consortium.EC-Earth3-CC.ssp245.r1i1p1f1.fx.areacella.gr.v20210113.areacella_fx_EC-Earth3-CC_ssp245_r1i1p1f1_gr.nc"',
+        ]
+    }
+    ds = xr.open_dataset(
+        selection,  # type: ignore[arg-type]
+        esgpull_path=esgpull_path,
+        engine="esgf",
+        index_node=index_node,
+        executor=executor,
+        download=True,
+        chunks={},
+    )
+    ds.to_netcdf(tmp_path / "out.nc")
+    with xr.open_dataset(tmp_path / "out.nc", decode_coords=False) as actual:
+        assert actual["tas"].attrs["coordinates"] == "areacella"
@@ -1,17 +1,35 @@
 import asyncio
+import contextlib
 import dataclasses
+import hashlib
+import itertools
+import json
 import logging
-from collections import defaultdict
-from collections.abc import Callable, Hashable, Iterable
-from functools import cached_property
+import operator
+import os
+import shutil
+import tempfile
+import threading
+from collections import defaultdict, deque
+from collections.abc import Callable, Hashable, Iterable, Iterator, Mapping
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from functools import cache, cached_property, partial
+from http import HTTPStatus
 from pathlib import Path
+from types import MappingProxyType
 from typing import Any, Literal, get_args
 
+import aiofiles
+import aiohttp
+import numpy as np
 import tqdm
 import xarray as xr
 from esgpull import Esgpull, File, Query
-from esgpull.fs import FileCheck
+from esgpull.fs import FileCheck, Filesystem
+from esgpull.install_config import InstallConfig
 from xarray import DataArray, Dataset, Variable
+from xarray.backends import H5NetCDFStore
+from xarray.core.types import JoinOptions, T_Chunks
 
 DATASET_ID_KEYS = Literal[
     "project",
@@ -25,10 +43,30 @@ DATASET_ID_KEYS = Literal[
     "grid_label",
     "version",
 ]
+DATASET_ID_KEY_TUPLE: tuple[DATASET_ID_KEYS, ...] = get_args(DATASET_ID_KEYS)
 BOUNDS_DIMS = {"axis_nbounds", "bnds", "nbnd"}
+FILE_ENCODING_KEYS = (
+    "chunksizes",
+    "contiguous",
+    "coordinates",
+    "original_shape",
+    "preferred_chunks",
+    "source",
+)
+MAX_WORKERS = 32
+HTTP_KEEPALIVE_TIMEOUT = 60
+PROGRESS_MININTERVAL = 0.5
+DOWNLOAD_CHUNK_SIZE = 2**20
 
 LOGGER = logging.getLogger()
 
+_ESGPULL_CACHE: dict[tuple[str, str | None, bool], Esgpull] = {}
+_ESGPULL_CACHE_LOCK = threading.Lock()
+
+
+class RangeNotSupportedError(ValueError):
+    pass
+
 
 def use_new_combine_kwarg_defaults[**P, T](func: Callable[P, T]) -> Callable[P, T]:
     def wrapper(*args: P.args, **kwds: P.kwargs) -> T:
@@ -38,15 +76,27 @@ def use_new_combine_kwarg_defaults[**P, T](func: Callable[P, T]) -> Callable[P,
     return wrapper
 
 
-def dataset_id_to_dict(dataset_id: str) -> dict[DATASET_ID_KEYS, str]:
-    keys = get_args(DATASET_ID_KEYS)
-    return dict(zip(keys, dataset_id.split("."), strict=True))
+async def get_http_client(**kwargs: Any) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit_per_host=MAX_WORKERS,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, **kwargs)
+
 
+@cache
+def dataset_id_to_dict(dataset_id: str) -> Mapping[DATASET_ID_KEYS, str]:
+    return MappingProxyType(
+        dict(zip(DATASET_ID_KEY_TUPLE, dataset_id.split("."), strict=True))
+    )
 
-def combine_datasets(datasets: list[Dataset]) -> Dataset:
+
+def combine_datasets(datasets: list[Dataset], join: JoinOptions = "exact") -> Dataset:
+    if len(datasets) == 1:
+        return datasets[0]
     obj = xr.combine_by_coords(
         datasets,
-        join="exact",
+        join=join,
         combine_attrs="drop_conflicts",
     )
     if isinstance(obj, DataArray):
@@ -54,12 +104,88 @@ def combine_datasets(datasets: list[Dataset]) -> Dataset:
     return obj
 
 
-def move_dimensionless_coords_to_attrs(ds: Dataset) -> Dataset:
+def concat_along_time(datasets: list[Dataset], join: JoinOptions = "exact") -> Dataset:
+    if len(datasets) == 1:
+        return datasets[0]
+    if not all("time" in ds.indexes for ds in datasets):
+        return combine_datasets(datasets, join=join)
+    return xr.concat(
+        sorted(datasets, key=lambda ds: ds.indexes["time"][0]),
+        dim="time",
+        join=join,
+        combine_attrs="drop_conflicts",
+    )
+
+
+def concat_along_dims(
+    datasets: dict[tuple[str, ...], Dataset],
+    dims: list[DATASET_ID_KEYS],
+    join: JoinOptions = "exact",
+) -> Dataset:
+    if not dims:
+        (ds,) = datasets.values()
+        return ds
+    dim, *inner_dims = dims
+    labels = sorted({key[0] for key in datasets})
+    objs = [
+        concat_along_dims(
+            {key[1:]: ds for key, ds in datasets.items() if key[0] == label},
+            inner_dims,
+            join=join,
+        )
+        for label in labels
+    ]
+    return xr.concat(
+        objs,
+        dim=Variable(dim, np.array(labels, dtype=object)),
+        join=join,
+        combine_attrs="drop_conflicts",
+    )
+
+
+def group_by_concat_dims(
+    datasets: dict[str, Dataset],
+    concat_dims: list[DATASET_ID_KEYS],
+    join: JoinOptions = "exact",
+) -> list[Dataset]:
+    if not concat_dims:
+        return list(datasets.values())
+
+    groups: dict[tuple[str, ...], dict[tuple[str, ...], Dataset]] = defaultdict(dict)
+    for dataset_id, ds in datasets.items():
+        dataset_id_dict = dataset_id_to_dict(dataset_id)
+        key = tuple(
+            value
+            for name, value in dataset_id_dict.items()
+            if name not in concat_dims and name != "version"
+        )
+        labels = tuple(dataset_id_dict[dim] for dim in concat_dims)
+        if labels in groups[key]:
+            msg = f"Multiple datasets to concatenate at {labels}: {dataset_id}"
+            raise ValueError(msg)
+        groups[key][labels] = ds
+    return [
+        concat_along_dims(group, concat_dims, join=join) for group in groups.values()
+    ]
+
+
+def scan_files(directories: Iterable[Path]) -> set[Path]:
+    paths: set[Path] = set()
+    for directory in directories:
+        with contextlib.suppress(FileNotFoundError), os.scandir(directory) as entries:
+            paths.update(Path(entry.path) for entry in entries if entry.is_file())
+    return paths
+
+
+def set_coords_and_attrs(ds: Dataset) -> Dataset:
+    coords = []
     attrs = {}
-    for var, da in ds.coords.items():
-        if not da.dims:
-            attrs[var] = da.item()
-    ds = ds.drop_vars(list(attrs))
+    for name, var in ds.variables.items():
+        if not var.dims:
+            attrs[name] = var.values.item()
+        elif BOUNDS_DIMS.intersection(var.dims) or "time" not in var.dims:
+            coords.append(name)
+    ds = ds.set_coords(coords).drop_vars(list(attrs))
     for da in ds.data_vars.values():
         da.attrs.update(attrs)
     return ds
@@ -75,6 +201,22 @@ def pop_attrs(obj: Dataset | DataArray | Variable, keys: str | Iterable[str]) ->
             pop_attrs(var, keys)
 
 
+def bounded_map[T, R](
+    executor: Executor, func: Callable[[T], R], iterable: Iterable[T], window: int
+) -> Iterator[R]:
+    futures: deque[Future[R]] = deque()
+    try:
+        for item in iterable:
+            if len(futures) >= window:
+                yield futures.popleft().result()
+            futures.append(executor.submit(func, item))
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
 @dataclasses.dataclass
 class Client:
     selection: dict[str, str | list[str]]
@@ -83,18 +225,40 @@ class Client:
     retries: int = 0
     check_files: bool = True
     verify_ssl: bool = False
+    refresh: bool = False
+    hdf5_cache_bytes: int | None = None
+    hdf5_backend: Literal["h5py", "pyfive"] | None = None
+    http_block_size: int | None = None
+    http_cache_type: str | None = None
+    trust_alignment: bool = False
+    parallel_parts: int = 1
+    file_chunks: T_Chunks = "auto"
+    executor: ThreadPoolExecutor | None = None
+
+    @property
+    def _install_path(self) -> Path:
+        if self.esgpull_path is not None:
+            return Path(self.esgpull_path).resolve()
+        if InstallConfig.current is not None:
+            return InstallConfig.current.path.resolve()
+        return InstallConfig.default.resolve()
 
     @cached_property
     def _client(self) -> Esgpull:
-        client = Esgpull(
-            path=self.esgpull_path,
-            install=True,
-            load_db=False,
-        )
-        client.config.download.disable_ssl = not self.verify_ssl
-        if self.index_node is not None:
-            client.config.api.index_node = self.index_node
-        return client
+        key = (str(self._install_path), self.index_node, self.verify_ssl)
+        with _ESGPULL_CACHE_LOCK:
+            client = _ESGPULL_CACHE.get(key)
+            if client is None or not client.path.is_dir():
+                client = Esgpull(
+                    path=self.esgpull_path,
+                    install=True,
+                    load_db=False,
+                )
+                client.config.download.disable_ssl = not self.verify_ssl
+                if self.index_node is not None:
+                    client.config.api.index_node = self.index_node
+                _ESGPULL_CACHE[key] = client
+            return client
 
     @cached_property
     def _query(self) -> Query:
@@ -103,66 +267,275 @@ class Client:
             options={"distrib": True, "latest": True},
         )
 
+    @contextlib.contextmanager
+    def _executor(self) -> Iterator[ThreadPoolExecutor]:
+        if self.executor is not None:
+            yield self.executor
+        else:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                yield executor
+
+    @cached_property
+    def _storage_options(self) -> dict[str, Any]:
+        storage_options = {"ssl": self.verify_ssl, "get_client": get_http_client}
+        if self.http_block_size is not None:
+            storage_options["block_size"] = self.http_block_size
+        if self.http_cache_type is not None:
+            storage_options["cache_type"] = self.http_cache_type
+        return storage_options
+
+    @cached_property
+    def _driver_kwds(self) -> dict[str, Any] | None:
+        driver_kwds: dict[str, Any] = {}
+        if self.hdf5_cache_bytes is not None:
+            driver_kwds["rdcc_nbytes"] = self.hdf5_cache_bytes
+        if self.hdf5_backend is not None:
+            driver_kwds["backend"] = self.hdf5_backend
+        return driver_kwds or None
+
+    def _lock(self, download: bool) -> Literal[False] | None:
+        return False if self.hdf5_backend == "pyfive" and download else None
+
+    @cached_property
+    def _join(self) -> JoinOptions:
+        return "override" if self.trust_alignment else "exact"
+
     @cached_property
     def n_tries(self) -> int:
         return self.retries + 1 if self.retries >= 0 else 1
 
+    @cached_property
+    def _files_cache_path(self) -> Path:
+        key = json.dumps(
+            [self._client.config.api.index_node, self.selection], sort_keys=True
+        )
+        filename = hashlib.sha256(key.encode()).hexdigest()
+        return self._client.path / ".xr_esgf_cache" / f"{filename}.json"
+
     @cached_property
     def files(self) -> list[File]:
-        return self._client.context.files(
+        path = self._files_cache_path
+        if not self.refresh and path.exists():
+            files = [File.fromdict(source) for source in json.loads(path.read_text())]
+            for file in files:
+                file.compute_sha()
+            if files:
+                return files
+
+        files = self._client.context.files(
             self._query,
             max_hits=None,
             keep_duplicates=False,
         )
+        if files:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=path.parent, suffix=".tmp", delete=False
+            ) as f:
+                json.dump([file.asdict() for file in files], f)
+            Path(f.name).replace(path)
+        return files
+
+    @cached_property
+    def _paths(self) -> dict[str, Path]:
+        fs = self._client.fs
+        return {file.file_id: fs[file].drs for file in self.files}
+
+    def _is_missing(self, file: File, fs: Filesystem, existing: set[Path]) -> bool:
+        if self._paths[file.file_id] not in existing:
+            return True
+        return self.check_files and fs.check(file) != FileCheck.Ok
 
     @property
     def missing_files(self) -> list[File]:
-        missing_files = []
-        for file in tqdm.tqdm(self.files, desc="Looking for missing files"):
-            file_path = Path(str(self._client.fs[file]))
-            if (self.check_files and self._client.fs.check(file) != FileCheck.Ok) or (
-                not self.check_files and not file_path.exists()
+        existing = scan_files({path.parent for path in self._paths.values()})
+        is_missing = partial(self._is_missing, fs=self._client.fs, existing=existing)
+        with self._executor() as executor:
+            missing_flags = list(
+                tqdm.tqdm(
+                    executor.map(is_missing, self.files),
+                    total=len(self.files),
+                    mininterval=PROGRESS_MININTERVAL,
+                    desc="Looking for missing files",
+                )
+            )
+        return [
+            file
+            for file, missing in zip(self.files, missing_flags, strict=True)
+            if missing
+        ]
+
+    async def _download_part(
+        self,
+        session: aiohttp.ClientSession,
+        file: File,
+        tmp: Path,
+        start: int,
+        end: int,
+    ) -> None:
+        headers = {"Range": f"bytes={start}-{end}"}
+        async with session.get(file.url, headers=headers, ssl=self.verify_ssl) as resp:
+            resp.raise_for_status()
+            if (
+                resp.status != HTTPStatus.PARTIAL_CONTENT
+                and end - start + 1 != file.size
             ):
-                missing_files.append(file)
-        return missing_files
+                msg = f"Range requests not supported: {file.url}"
+                raise RangeNotSupportedError(msg)
+            async with aiofiles.open(tmp, "r+b") as f:
+                await f.seek(start)
+                async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await f.write(chunk)
+
+    async def _download_parts(
+        self,
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        file: File,
+    ) -> File:
+        fs = self._client.fs
+        tmp = fs[file].tmp
+        part_size = max(-(-file.size // self.parallel_parts), 1)
+        async with semaphore:
+            tmp.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                async with aiofiles.open(tmp, "wb") as f:
+                    await f.truncate(file.size)
+                async with asyncio.TaskGroup() as task_group:
+                    for start in range(0, file.size, part_size):
+                        end = min(start + part_size, file.size) - 1
+                        task_group.create_task(
+                            self._download_part(session, file, tmp, start, end)
+                        )
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+
+        check = await asyncio.to_thread(fs.check_impl, file, tmp)
+        if check != FileCheck.Ok:
+            tmp.unlink()
+            raise check.as_err(file)
+        path = self._paths[file.file_id]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        await asyncio.to_thread(shutil.move, tmp, path)
+        return file
+
+    async def _download(
+        self, files: list[File]
+    ) -> tuple[list[File], list[BaseException]]:
+        if self.parallel_parts <= 1:
+            downloaded, errors = await self._client.download(files, use_db=False)
+            return downloaded, [error.err for error in errors]
+
+        config = self._client.config.download
+        semaphore = asyncio.Semaphore(config.max_concurrent)
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=config.http_timeout)
+        async with await get_http_client(timeout=timeout) as session:
+            results = await asyncio.gather(
+                *(self._download_parts(session, semaphore, file) for file in files),
+                return_exceptions=True,
+            )
+
+        downloaded = []
+        failures = []
+        fallback = []
+        for file, result in zip(files, results, strict=True):
+            if isinstance(result, File):
+                downloaded.append(result)
+            elif isinstance(result, BaseExceptionGroup) and result.subgroup(
+                RangeNotSupportedError
+            ):
+                fallback.append(file)
+            else:
+                failures.append(result)
+
+        if fallback:
+            LOGGER.debug(f"Downloading {len(fallback)} file(s) without Range requests")
+            fallback_downloaded, errors = await self._client.download(
+                fallback, use_db=False
+            )
+            downloaded.extend(fallback_downloaded)
+            failures.extend(error.err for error in errors)
+        return downloaded, failures
 
     def download(self) -> list[File]:
         files = []
-        for _ in range(self.n_tries):
-            downloaded, errors = asyncio.run(
-                self._client.download(self.missing_files, use_db=False)
-            )
-            files.extend(downloaded)
-            if not errors:
-                break
-
-        exceptions = []
-        for error in errors:
-            err = error.err
-            if isinstance(err, Exception):
-                exceptions.append(err)
+        with asyncio.Runner() as runner:
+            for _ in range(self.n_tries):
+                downloaded, errors = runner.run(self._download(self.missing_files))
+                files.extend(downloaded)
+                if not errors:
+                    break
+
+        exceptions = [err for err in errors if isinstance(err, Exception)]
         if exceptions:
             msg = "Download errors"
             raise ExceptionGroup(msg, exceptions)
         return files
 
+    def _source(self, file: File, download: bool) -> str | Path:
+        return self._paths[file.file_id] if download else file.url
+
+    def peek_dims(self, file: File, download: bool = False) -> dict[str, int]:
+        store = H5NetCDFStore.open(
+            self._source(file, download),
+            lock=self._lock(download),
+            driver_kwds=self._driver_kwds,
+            storage_options=self._storage_options,
+        )
+        try:
+            return dict(store.get_dimensions())
+        finally:
+            store.close()
+
+    def _open_one(
+        self,
+        file: File,
+        drop_variables: str | Iterable[str] | None,
+        download: bool,
+        sel: dict[Hashable, Any],
+        ignore_spatial_coords: set[str],
+        mask_and_scale: bool,
+    ) -> tuple[str, Dataset]:
+        ds = xr.open_dataset(
+            self._source(file, download),
+            chunks=self.file_chunks,
+            engine="h5netcdf",
+            drop_variables=drop_variables,
+            mask_and_scale=mask_and_scale,
+            driver_kwds=self._driver_kwds,
+            lock=self._lock(download),
+            storage_options=self._storage_options,
+        )
+
+        ds = ds.sel({k: v for k, v in sel.items() if k in ds.dims})
+
+        if ignore_spatial_coords.intersection(ds.variables):
+            ds = ds.drop_vars(set(ds.variables) & {"lat", "lon"})
+
+        for name, coord in ds.coords.items():
+            if "time" not in coord.dims:
+                ds.variables[name].load()
+
+        for encoding in [ds.encoding, *(var.encoding for var in ds.variables.values())]:
+            for key in FILE_ENCODING_KEYS:
+                encoding.pop(key, None)
+
+        return file.dataset_id, ds
+
     def _open_datasets(
         self,
-        concat_dims: DATASET_ID_KEYS | Iterable[DATASET_ID_KEYS] | None,
         drop_variables: str | Iterable[str] | None,
         download: bool,
         show_progress: bool,
         sel: dict[Hashable, Any],
         ignore_spatial_coords: str | Iterable[str],
+        mask_and_scale: bool,
     ) -> dict[str, Dataset]:
         sel = {
             k: slice(*v["slice"]) if isinstance(v, dict) else v for k, v in sel.items()
         }
 
-        if isinstance(concat_dims, str):
-            concat_dims = [concat_dims]
-        concat_dims = concat_dims or []
-
         if isinstance(ignore_spatial_coords, str):
             ignore_spatial_coords = {ignore_spatial_coords}
         ignore_spatial_coords = set(ignore_spatial_coords)
@@ -170,45 +543,35 @@ class Client:
         if download:
             self.download()
 
-        grouped_objects = defaultdict(list)
-        for file in tqdm.tqdm(
-            self.files, disable=not show_progress, desc="Opening datasets"
-        ):
-            ds = xr.open_dataset(
-                self._client.fs[file].drs if download else file.url,
-                chunks=-1,
-                engine="h5netcdf",
-                drop_variables=drop_variables,
-                storage_options={"ssl": self.verify_ssl},
-            )
-
-            ds = ds.sel({k: v for k, v in sel.items() if k in ds.dims})
-
-            if ignore_spatial_coords.intersection(ds.variables):
-                ds = ds.drop_vars(set(ds.variables) & {"lat", "lon"})
-
-            if all(ds.sizes.values()):
-                grouped_objects[file.dataset_id].append(ds.drop_encoding())
-
+        open_one = partial(
+            self._open_one,
+            drop_variables=drop_variables,
+            download=download,
+            sel=sel,
+            ignore_spatial_coords=ignore_spatial_coords,
+            mask_and_scale=mask_and_scale,
+        )
         combined_datasets = {}
-        for dataset_id, datasets in grouped_objects.items():
-            dataset_id_dict = dataset_id_to_dict(dataset_id)
-            if len(datasets) == 1:
-                (ds,) = datasets
-            else:
-                ds = combine_datasets(datasets)
-
-            ds = ds.set_coords([
-                name
-                for name, da in ds.variables.items()
-                if BOUNDS_DIMS.intersection(da.dims) or "time" not in da.dims
-            ])
-
-            ds = move_dimensionless_coords_to_attrs(ds)
+        files = sorted(self.files, key=operator.attrgetter("dataset_id"))
+        with self._executor() as executor:
+            results = tqdm.tqdm(
+                bounded_map(executor, open_one, files, window=MAX_WORKERS),
+                total=len(files),
+                mininterval=PROGRESS_MININTERVAL,
+                disable=not show_progress,
+                desc="Opening datasets",
+            )
+            for dataset_id, group in itertools.groupby(
+                results, key=operator.itemgetter(0)
+            ):
+                objects = [ds for _, ds in group if all(ds.sizes.values())]
+                if not objects:
+                    continue
 
-            ds = ds.expand_dims({dim: [dataset_id_dict[dim]] for dim in concat_dims})
-            combined_datasets[dataset_id] = ds
-            LOGGER.debug(f"{dataset_id}: {dict(ds.sizes)}")
+                ds = concat_along_time(objects, join=self._join)
+                ds = set_coords_and_attrs(ds)
+                combined_datasets[dataset_id] = ds
+                LOGGER.debug(f"{dataset_id}: {dict(ds.sizes)}")
 
         return combined_datasets
 
@@ -222,28 +585,34 @@ class Client:
         sel: dict[Hashable, Any] | None = None,
         ignore_spatial_coords: str | Iterable[str] | None = None,
         drop_attributes: str | Iterable[str] | None = None,
+        mask_and_scale: bool = True,
     ) -> Dataset:
+        if isinstance(concat_dims, str):
+            concat_dims = [concat_dims]
+        concat_dims = list(concat_dims or [])
+
         combined_datasets = self._open_datasets(
-            concat_dims=concat_dims,
             drop_variables=drop_variables,
             download=download,
             show_progress=show_progress,
             sel=sel or {},
             ignore_spatial_coords=ignore_spatial_coords or {},
+            mask_and_scale=mask_and_scale,
         )
 
-        obj = combine_datasets([ds.reset_coords() for ds in combined_datasets.values()])
+        datasets = group_by_concat_dims(combined_datasets, concat_dims, join=self._join)
+        obj = combine_datasets([ds.reset_coords() for ds in datasets], join=self._join)
 
-        coords: set[Hashable] = set()
+        coords: set[Hashable] = set(concat_dims)
         for ds in combined_datasets.values():
             coords.update(ds.coords)
         obj = obj.set_coords(coords)
 
         for name, var in obj.variables.items():
-            if name not in obj.dims:
+            if var.chunks and name not in obj.dims:
                 var.encoding["preferred_chunks"] = dict(var.chunksizes)
 
         obj.attrs["coordinates"] = " ".join(sorted(str(coord) for coord in obj.coords))
-        obj.attrs["dataset_ids"] = sorted(combined_datasets)
+        obj.attrs["dataset_ids"] = list(combined_datasets)
         pop_attrs(obj, drop_attributes or [])
         return obj
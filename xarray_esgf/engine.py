@@ -1,9 +1,11 @@
 from collections.abc import Hashable, Iterable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Any, Literal
 
 from xarray import Dataset
 from xarray.backends import BackendEntrypoint
+from xarray.core.types import T_Chunks
 
 from .client import DATASET_ID_KEYS, Client
 
@@ -19,12 +21,22 @@ class EsgfBackendEntrypoint(BackendEntrypoint):
         retries: int = 0,
         check_files: bool = True,
         verify_ssl: bool = False,
+        refresh: bool = False,
+        hdf5_cache_bytes: int | None = None,
+        hdf5_backend: Literal["h5py", "pyfive"] | None = None,
+        http_block_size: int | None = None,
+        http_cache_type: str | None = None,
+        trust_alignment: bool = False,
+        parallel_parts: int = 1,
+        file_chunks: T_Chunks = "auto",
+        executor: ThreadPoolExecutor | None = None,
         concat_dims: DATASET_ID_KEYS | Iterable[DATASET_ID_KEYS] | None = None,
         download: bool = False,
         show_progress: bool = True,
         sel: dict[Hashable, Any] | None = None,
         ignore_spatial_coords: str | Iterable[str] | None = None,
         drop_attributes: str | Iterable[str] | None = None,
+        mask_and_scale: bool = True,
     ) -> Dataset:
         client = Client(
             selection=filename_or_obj,
@@ -33,6 +45,15 @@ class EsgfBackendEntrypoint(BackendEntrypoint):
             retries=retries,
             check_files=check_files,
             verify_ssl=verify_ssl,
+            refresh=refresh,
+            hdf5_cache_bytes=hdf5_cache_bytes,
+            hdf5_backend=hdf5_backend,
+            http_block_size=http_block_size,
+            http_cache_type=http_cache_type,
+            trust_alignment=trust_alignment,
+            parallel_parts=parallel_parts,
+            file_chunks=file_chunks,
+            executor=executor,
         )
         return client.open_dataset(
             concat_dims=concat_dims,
@@ -42,6 +63,7 @@ class EsgfBackendEntrypoint(BackendEntrypoint):
             sel=sel,
             ignore_spatial_coords=ignore_spatial_coords,
             drop_attributes=drop_attributes,
+            mask_and_scale=mask_and_scale,
         )
 
     open_dataset_parameters = (
@@ -51,12 +73,22 @@ class EsgfBackendEntrypoint(BackendEntrypoint):
         "retries",
         "check_files",
         "verify_ssl",
+        "refresh",
+        "hdf5_cache_bytes",
+        "hdf5_backend",
+        "http_block_size",
+        "http_cache_type",
+        "trust_alignment",
+        "parallel_parts",
+        "file_chunks",
+        "executor",
         "concat_dims",
         "download",
         "show_progress",
         "sel",
         "ignore_spatial_coords",
         "drop_attributes",
+        "mask_and_scale",
     )
 
     def guess_can_open(self, filename_or_obj: Any) -> bool: